@@ -17,6 +17,7 @@ from slackbot_release.tc import graph_is_complete
 from slackbot_release.utils import get_config, release_in_message
 from slackbot_release.db import update_releases, task_tracked, update_tasks_in_thread
 from slackbot_release.db import track_slack_thread, mark_phase_as_done, delete_old_threads, create_db
+from slackbot_release.db import load_state, flush_state
 
 ### logging
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -255,6 +256,13 @@ async def periodic_releases_status(config=CONFIG, logger=LOGGER):
 
         await asyncio.sleep(300)
 
+
+async def periodic_state_flush(config=CONFIG, logger=LOGGER):
+    # write-behind: batch every state change since the last cycle into one db transaction
+    while True:
+        await asyncio.sleep(60)
+        flush_state()
+
 @slack.RTMClient.run_on(event="message")
 async def receive_message(**payload):
 
@@ -306,15 +314,22 @@ async def receive_message(**payload):
 
 async def main():
     create_db()
+    load_state()
     # real-time-messaging Slack client
     client = slack.RTMClient(token=CONFIG["slack_api_token"], run_async=True)
     # periodically check the taskcluster group status of every release in flight
     periodic_releases_status_task = asyncio.create_task(periodic_releases_status())
     periodic_stuck_tasks_status_task = asyncio.create_task(periodic_stuck_tasks_status())
-
-    await asyncio.gather(client.start(),
-                         periodic_releases_status_task,
-                         periodic_stuck_tasks_status_task)
+    # persist in-memory release state to the db
+    periodic_state_flush_task = asyncio.create_task(periodic_state_flush())
+
+    try:
+        await asyncio.gather(client.start(),
+                             periodic_releases_status_task,
+                             periodic_stuck_tasks_status_task,
+                             periodic_state_flush_task)
+    finally:
+        flush_state()
 
 
 if __name__ == "__main__":
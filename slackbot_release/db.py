@@ -5,8 +5,7 @@ import logging
 from sqlalchemy import Column, String, Integer, ForeignKey, Boolean
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.sql import not_
+from sqlalchemy.orm import sessionmaker, relationship, selectinload
 
 
 from slackbot_release.shipit import get_shipit_releases
@@ -81,109 +80,225 @@ NamedSlackThread = collections.namedtuple('SlackThread', 'threadid, tasks')
 NamedTask = collections.namedtuple('SlackThread', 'taskid, threadid')
 
 
-def task_tracked(task, release_name):
+
+
+#### in-memory state
+# The bot's release/phase/thread/task state lives in memory and is the only thing
+# background loops and slack commands read from or write to. Every mutator below is
+# synchronous, so within the asyncio event loop each one runs to completion without
+# interleaving with another: this module is the single writer. Changes are recorded
+# as dirty release names and persisted to sqlite in one transaction by flush_state().
+_releases = {}
+_dirty_releases = set()
+_deleted_releases = set()
+
+
+def _mark_dirty(release_name):
+    _deleted_releases.discard(release_name)
+    _dirty_releases.add(release_name)
+
+
+def _find_thread(threadid):
+    for release in _releases.values():
+        if threadid in release["slack_threads"]:
+            return release
+    return None
+
+
+def _snapshot(release):
+    "build a read only copy of a release so callers can never mutate state directly"
+    return NamedRelease(
+        name=release["name"],
+        product=release["product"],
+        version=release["version"],
+        repo=release["repo"],
+        revision=release["revision"],
+        phases=[NamedPhase(name=name, **phase) for name, phase in release["phases"].items()],
+        slack_threads=[NamedSlackThread(threadid=threadid, tasks=list(tasks))
+                       for threadid, tasks in release["slack_threads"].items()],
+    )
+
+
+def load_state():
+    "rebuild in-memory state from the db. Called once at startup"
+    _releases.clear()
+    _dirty_releases.clear()
+    _deleted_releases.clear()
     with session_scope() as session:
-        release = session.query(Release).get(release_name)
-        for thread in release.slack_threads:
-            if task in [t.taskid for t in thread.tasks]:
-                return True
+        query = session.query(Release).options(
+            selectinload(Release.phases),
+            selectinload(Release.slack_threads).selectinload(SlackThread.tasks),
+        )
+        for release in query:
+            _releases[release.name] = {
+                "name": release.name,
+                "product": release.product,
+                "version": release.version,
+                "repo": release.repo,
+                "revision": release.revision,
+                "phases": {
+                    phase.name: {"groupid": phase.groupid, "triggered": phase.triggered, "done": phase.done}
+                    for phase in sorted(release.phases, key=lambda p: p.id)
+                },
+                "slack_threads": {
+                    thread.threadid: [t.taskid for t in thread.tasks] for thread in release.slack_threads
+                },
+            }
+    LOGGER.info(f"Loaded {len(_releases)} releases from db")
+
+
+def flush_state():
+    "write-behind: persist every release changed since the last flush in a single transaction"
+    if not _dirty_releases and not _deleted_releases:
+        return
+    with session_scope() as session:
+        if _deleted_releases:
+            for release in session.query(Release).filter(Release.name.in_(_deleted_releases)):
+                session.delete(release)
+
+        if _dirty_releases:
+            existing = {
+                r.name: r for r in session.query(Release).filter(Release.name.in_(_dirty_releases))
+            }
+            for name in _dirty_releases:
+                state = _releases.get(name)
+                if state is None:
+                    continue
+                release = existing.get(name)
+                if release is None:
+                    release = Release(name=name)
+                    session.add(release)
+                release.product = state["product"]
+                release.version = state["version"]
+                release.repo = state["repo"]
+                release.revision = state["revision"]
+
+                phases = {phase.name: phase for phase in release.phases}
+                for phase_name, phase_state in state["phases"].items():
+                    phase = phases.get(phase_name)
+                    if phase is None:
+                        phase = Phase(name=phase_name)
+                        release.phases.append(phase)
+                    phase.groupid = phase_state["groupid"]
+                    phase.triggered = phase_state["triggered"]
+                    phase.done = phase_state["done"]
+
+                threads = {thread.threadid: thread for thread in release.slack_threads}
+                release.slack_threads = [threads.get(threadid) or SlackThread(threadid=threadid)
+                                         for threadid in state["slack_threads"]]
+                for thread in release.slack_threads:
+                    taskids = state["slack_threads"][thread.threadid]
+                    kept = [t for t in thread.tasks if t.taskid in taskids]
+                    kept_ids = {t.taskid for t in kept}
+                    thread.tasks = kept + [Task(taskid=taskid) for taskid in taskids if taskid not in kept_ids]
+
+    LOGGER.info(f"Flushed {len(_dirty_releases)} updated and {len(_deleted_releases)} deleted releases to db")
+    _dirty_releases.clear()
+    _deleted_releases.clear()
+
+
+def task_tracked(task, release_name):
+    release = _releases.get(release_name)
+    if release is None:
         return False
+    return any(task in tasks for tasks in release["slack_threads"].values())
 
 def track_slack_thread(threadid, tasks, release_name):
-    with session_scope() as session:
-        release = session.query(Release).get(release_name)
-        thread = SlackThread(threadid=threadid)
-        thread.tasks = [Task(taskid=taskid) for taskid in tasks]
-        release.slack_threads.append(thread)
+    release = _releases.get(release_name)
+    if release is None:
+        LOGGER.warning(f"Can't track thread {threadid}, {release_name} is no longer tracked")
+        return
+    release["slack_threads"][threadid] = list(tasks)
+    _mark_dirty(release_name)
 
 def update_tasks_in_thread(threadid, tasks):
-    with session_scope() as session:
-        thread = session.query(SlackThread).get(threadid)
-        thread.tasks = [Task(taskid=taskid) for taskid in tasks]
+    release = _find_thread(threadid)
+    if release is None:
+        return  # release finished and was scrubbed while we were polling taskcluster
+    tasks = list(tasks)
+    if release["slack_threads"][threadid] != tasks:
+        release["slack_threads"][threadid] = tasks
+        _mark_dirty(release["name"])
 
 def mark_phase_as_done(phase_name, release_name):
-    with session_scope() as session:
-        release = session.query(Release).get(release_name)
-        target_phase = next(phase for phase in release.phases if phase.name == phase_name)
-        target_phase.done = True
+    release = _releases.get(release_name)
+    if release is None or phase_name not in release["phases"]:
+        return
+    if not release["phases"][phase_name]["done"]:
+        release["phases"][phase_name]["done"] = True
+        _mark_dirty(release_name)
 
 def add_release(shipit_release):
-    with session_scope() as session:
-        new_release = Release(
-            name=shipit_release["name"],
-            product=shipit_release["product"],
-            version=shipit_release["version"],
-            repo=shipit_release["project"],
-            revision=shipit_release["revision"]
-        )
-        phases = []
-        for shipit_phase in shipit_release["phases"]:
-            phases.append(Phase(
-                name=shipit_phase["name"],
-                groupid=shipit_phase["actionTaskId"],
-                triggered=True if shipit_phase["completed"] else False,
-                done=False  # done tracks if TC graph is complete
-            ))
-        new_release.phases = phases
-        session.add(new_release)
-        return new_release
+    release = {
+        "name": shipit_release["name"],
+        "product": shipit_release["product"],
+        "version": shipit_release["version"],
+        "repo": shipit_release["project"],
+        "revision": shipit_release["revision"],
+        "phases": {},
+        "slack_threads": {},
+    }
+    for shipit_phase in shipit_release["phases"]:
+        release["phases"][shipit_phase["name"]] = {
+            "groupid": shipit_phase["actionTaskId"],
+            "triggered": True if shipit_phase["completed"] else False,
+            "done": False,  # done tracks if TC graph is complete
+        }
+    _releases[release["name"]] = release
+    _mark_dirty(release["name"])
+    return _snapshot(release)
 
 def update_phases(shipit_release):
-    with session_scope() as session:
-        release = session.query(Release).get(shipit_release["name"])
-        for phase in release.phases:
-            # get corresponding shipit phase which holds live state
-            shipit_phase = next(i for i in shipit_release["phases"] if i["name"] == phase.name)
-            # update phase live state
-            phase.groupid = shipit_phase["actionTaskId"]
-            phase.triggered = True if shipit_phase["completed"] else False
+    release = _releases[shipit_release["name"]]
+    changed = False
+    for phase_name, phase in release["phases"].items():
+        # get corresponding shipit phase which holds live state
+        shipit_phase = next(i for i in shipit_release["phases"] if i["name"] == phase_name)
+        # update phase live state
+        groupid = shipit_phase["actionTaskId"]
+        triggered = True if shipit_phase["completed"] else False
+        if phase["groupid"] != groupid or phase["triggered"] != triggered:
+            phase["groupid"] = groupid
+            phase["triggered"] = triggered
+            changed = True
+    if changed:
+        _mark_dirty(release["name"])
 
 def delete_old_threads(release_name):
-    with session_scope() as session:
-        session.query(SlackThread).filter(not_(SlackThread.tasks.any())).delete(synchronize_session='fetch')
+    release = _releases.get(release_name)
+    if release is None:
+        return
+    old_threads = [threadid for threadid, tasks in release["slack_threads"].items() if not tasks]
+    for threadid in old_threads:
+        del release["slack_threads"][threadid]
+    if old_threads:
+        _mark_dirty(release_name)
 
 def delete_old_releases(shipit_releases):
     release_names = [r["name"] for r in shipit_releases]
-    with session_scope() as session:
-        for release in session.query(Release).all():
-            if release.name not in release_names:
-                session.delete(release)
+    for name in list(_releases):
+        if name not in release_names:
+            del _releases[name]
+            _dirty_releases.discard(name)
+            _deleted_releases.add(name)
 
 def get_releases():
-    releases = []
-    with session_scope() as session:
-        for release in session.query(Release).all():
-            r = NamedRelease(name=release.name,
-                             product=release.product,
-                             version=release.version,
-                             repo=release.repo,
-                             revision=release.revision,
-                             phases=[],
-                             slack_threads=[])
-            for phase in release.phases:
-                r.phases.append(NamedPhase(name=phase.name,
-                                groupid=phase.groupid,
-                                triggered=phase.triggered,
-                                done=phase.done))
-            for thread in release.slack_threads:
-                r.slack_threads.append(
-                    NamedSlackThread(threadid=thread.threadid, tasks=[t.taskid for t in thread.tasks])
-                )
-            releases.append(r)
-        return releases
+    return [_snapshot(release) for release in _releases.values()]
 
 def get_release(name):
-    with session_scope() as session:
-        return session.query(Release).get(name)
+    release = _releases.get(name)
+    return _snapshot(release) if release else None
 
 async def update_releases(config, logger=LOGGER):
     shipit_releases = await get_shipit_releases(config)
 
+    # no awaits past this point: the sync with shipit is applied to state atomically
+
     # delete old tracked releases no longer in shipit
     delete_old_releases(shipit_releases)
 
     for shipit_release in shipit_releases:
-        if not get_release(shipit_release["name"]):
+        if shipit_release["name"] not in _releases:
             add_release(shipit_release)
         else:
             update_phases(shipit_release)